@@ -20,6 +20,9 @@
 #		"MySensors_DB.txt" the same domoticz id and D_T_H of D_T_H_B domoticz Type, they will be combined by the script if present
 import time, calendar
 import json
+import os, signal
+import cProfile, pstats
+import BaseHTTPServer, urlparse
 import serial
 import requests
 # import sqlite3 # for future DB update?
@@ -40,6 +43,33 @@ MAX_NODE_ID = 255 			# maximum number of nodes allowed
 DOMOTICZ_IP = "127.0.0.1"	# IP of domoticz metering system (on this system)
 DOMOTICZ_PORT = "8080"		# Port number
 DOMOTICZ_MYSENSORS_ID = "2" # MySensors hardware ID in Domoticz
+###############################################
+# Domoticz switch change notifications (push)
+###############################################
+# Domoticz calls the local endpoint on a switch change, set in Domoticz: Switches -> Edit -> On/Off Action:
+#	http://127.0.0.1:8081/dcz?idx=<domoticz id>&data=On	(default: value in notification, optional &level=0..100)
+#	http://127.0.0.1:8081/dcz?idx=<domoticz id>			(fallback: value is read from Domoticz, blocks the main loop for one request)
+# test (stand-in for Domoticz): curl "http://127.0.0.1:8081/dcz?idx=12&data=Set%20Level&level=40"
+# echo protection: notifications within DCZ_NOTIFY_ECHO seconds after this controller updated the same
+# domoticz device (send_domoticz_dev, i.e. the node reported the state itself) are ignored and logged.
+# The window is checked when the main loop handles the notification (not on arrival), a real switch change
+# inside the window is only sent to the node by the DCZ_POLL_INTERVAL fallback poll
+DCZ_NOTIFY_IP = "127.0.0.1"	# listen address for notifications (local only)
+DCZ_NOTIFY_PORT = 8081		# listen port, None to disable and use polling only
+DCZ_NOTIFY_ECHO = 2			# ignore notifications for a device this long (seconds) after own update
+DCZ_NOTIFY_TIMEOUT = 1		# socket timeout (seconds) for a notification, a slow client cannot stall the main loop
+DCZ_POLL_INTERVAL = 60		# polling of Domoticz switches (seconds) as fallback, 1 if no notifications
+###############################################
+# Runtime profiling (on demand, while running)
+###############################################
+# toggle with: sudo kill -USR1 <id>  or create the control file: touch MySensors_profile.ctl
+PROFILE_SIGNAL = signal.SIGUSR1				# signal to start/stop profiling
+PROFILE_CONTROL_FILE = 'MySensors_profile.ctl' # control file to start/stop profiling, removed when seen
+PROFILE_WINDOW = 120						# maximum profiling time (seconds), stops automatically
+PROFILE_FILE = 'MySensors_profile'			# profile output prefix, time is added (.prof for pstats, .txt readable)
+SLOW_TELEGRAM_FILE = 'MySensors_slow_telegrams.txt' # report of the slowest telegrams (appended)
+SLOW_TELEGRAM_REPORT = 300					# report interval of slowest telegrams (seconds)
+SLOW_TELEGRAM_COUNT = 10					# number of slowest telegrams in report
 
 # MySensors message type definitions and handlers
 # message structure = [1]node-id ; [2]child-sensor-id; [3]message-type; [4]ack; [5]sub-type; [6]payload\n
@@ -152,6 +182,13 @@ def MSsetreqID(label):
 	global MS_SetReq  # list
 	return MS_SetReq[label]['id']
 
+def MSsetreqLabelForID(id):
+# get MySensors set request label for id, no error check
+	global MS_SetReq  # list
+	for sensor in MS_SetReq:
+		if MS_SetReq[sensor]['id'] == id:
+			return( sensor )
+
 # Internal types & values
 MS_Internal = {
     'I_BATTERY_LEVEL': {'id': 0, 'comment': 'Use this to report the battery level (in percent 0-100).'},
@@ -216,6 +253,7 @@ def DCZdeviceLabelForID(id):
 # Local variables
 ##########################################
 NodeIds = [] # list with used/available Node id's, filled from MySensors_DB at startup
+dcz_sent = {} # time of last controller update per domoticz device, notification echo protection
 
 def initNodeIds():
 	# build the used Node table
@@ -434,6 +472,7 @@ def send_domoticz_dev(dcz_dev):
 	else:
 		pass  # do nothing, just send a dummy message, else risk of Domoticz DB crash
 		dcz_command= '/json.htm?type=command&param=getSunRiseSet'
+	dcz_sent[int(dcz_dev)] = time.time() # own update, notification of this change is an echo
 	result = dcz_request(dcz_command)
 	#print(dcz_command)
 	return(result)
@@ -603,28 +642,180 @@ def DB_poll_dcz(): #
 	dcz_switches = read_domoticz_switches() # read the switch values from domoticz
 	for dcz_switch in dcz_switches:
 		if (dcz_switch['LastUpdate'] > 0): #lastpoll): # disabled: check of updates only if change since lastpoll (need to be aware of delays.., )
-			DB_result = DB_get_dczdev(dcz_switch['idx']) # check if dcz sensor is in database
-			if DB_result != []: # if found in database (if not, nothing for now)
-				Sensor = DB_result[0] # database can return many results, use only first one for now
-				if (dcz_switch['LastUpdate'] > Sensor['LastUpdate']): # action and update if change from last time
-					# replace reading in DB and update LastUpdate, reading is level (opposed to on/off)
-					on_values = ["On", "Up", "Open"]
-					off_values = ["Off", "Down", "Closed"]
-					dcz_value =  dcz_switch['Data'] # domoticz response value
-					if (True in [True for match in on_values if match in dcz_value]): # if on, 100%
-						sensor_value = 100
-					elif (True in [True for match in off_values if match in dcz_value]): # if off, 0%
-						sensor_value = 0
-					else: # otherwise use dimmer level
-						sensor_value = dcz_switch['Level']
-					DB_replace_reading_dcz(dcz_switch['idx'], sensor_value)
-					#Debug: print("Switch present in DB, status updated", Sensor)
-					telegram = MS_make_telegram(Sensor['Node'],Sensor['Child'], MSmessageTypeID('SET'), 1, MSsetreqID('V_DIMMER'), sensor_value)
-					#print(telegram)
-					ser.write(telegram)
+			DB_update_dcz_switch(dcz_switch)
 	lastpoll = time.strftime("%F %T") # update the global poll variable
 	return
 
+## Update sensor from Domoticz switch status (from poll or notification) and send to MySensors
+def DB_update_dcz_switch(dcz_switch, notified=False):
+# input dcz_switch = domoticz switch attributes ('idx', 'Data', 'Level', 'LastUpdate')
+# notified = True for a notification: always a new change, no 'LastUpdate' check
+	DB_result = DB_get_dczdev(dcz_switch['idx']) # check if dcz sensor is in database
+	if DB_result != []: # if found in database (if not, nothing for now)
+		Sensor = DB_result[0] # database can return many results, use only first one for now
+		if notified or (dcz_switch['LastUpdate'] > Sensor['LastUpdate']): # action and update if change from last time
+			# replace reading in DB and update LastUpdate, reading is level (opposed to on/off)
+			on_values = ["On", "Up", "Open"]
+			off_values = ["Off", "Down", "Closed"]
+			dcz_value =  dcz_switch['Data'] # domoticz response value
+			if (True in [True for match in on_values if match in dcz_value]): # if on, 100%
+				sensor_value = 100
+			elif (True in [True for match in off_values if match in dcz_value]): # if off, 0%
+				sensor_value = 0
+			else: # otherwise use dimmer level
+				sensor_value = dcz_switch['Level']
+			DB_replace_reading_dcz(dcz_switch['idx'], sensor_value)
+			#Debug: print("Switch present in DB, status updated", Sensor)
+			telegram = MS_make_telegram(Sensor['Node'],Sensor['Child'], MSmessageTypeID('SET'), 1, MSsetreqID('V_DIMMER'), sensor_value)
+			#print(telegram)
+			ser.write(telegram)
+	return
+
+## Handle switch change notification from Domoticz, no polling needed
+def DB_notify_dcz(dcz_idx, dcz_data=None, dcz_level=None):
+# input dcz_idx = domoticz device id, dcz_data & dcz_level = new status (optional, else read from Domoticz)
+	if (time.time() - dcz_sent.get(dcz_idx, 0) < DCZ_NOTIFY_ECHO): # echo of own update, no action
+		print(time.strftime("%c") + " Notification for " + str(dcz_idx) + " within echo window ignored, wait for poll")
+		return
+	if dcz_data == None: # no status in notification, get from Domoticz (only this device)
+		dcz_switch = read_domoticz_dev(dcz_idx)
+		if dcz_switch == "Error":
+			return
+	else:
+		dcz_switch = {'idx': dcz_idx, 'Data': dcz_data, 'Level': int(dcz_level or 0)}
+	DB_update_dcz_switch(dcz_switch, notified=True)
+	return
+
+# Local HTTP endpoint for Domoticz notifications, handled from the main loop (non-blocking)
+class DCZ_notify_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+	timeout = DCZ_NOTIFY_TIMEOUT # socket timeout for reading the request
+	def do_GET(self):
+		# /dcz?idx=<domoticz id>[&data=<On/Off/Set Level>][&level=<0..100>]
+		url = urlparse.urlparse(self.path)
+		query = urlparse.parse_qs(url.query)
+		try:
+			if url.path != '/dcz':
+				raise KeyError(url.path)
+			DB_notify_dcz(int(query['idx'][0]), query.get('data', [None])[0], query.get('level', [None])[0])
+			self.send_response(200)
+		except (ValueError, KeyError, TypeError) as e:
+			print(time.strftime("%c") + " Wrong notification from Domoticz: " + self.path)
+			print(e)
+			self.send_response(400)
+		self.end_headers()
+	def log_message(self, format, *args):
+		pass # no logging of every request
+
+def start_dcz_notify():
+	# open notification endpoint, returns server or None (polling only)
+	if DCZ_NOTIFY_PORT == None:
+		return None
+	try:
+		server = BaseHTTPServer.HTTPServer((DCZ_NOTIFY_IP, DCZ_NOTIFY_PORT), DCZ_notify_handler)
+	except IOError as e:
+		print(time.strftime("%c") + " Domoticz notification port not available, polling only")
+		print(e)
+		return None
+	server.timeout = 0 # non-blocking in main loop
+	return server
+
+#############################################################
+# Runtime profiling routines
+###############################################################
+# profiling is toggled by PROFILE_SIGNAL or PROFILE_CONTROL_FILE and checked from the main loop
+# cProfile captures the main loop (process_MS_message, DB_poll_dcz, save_DB, ...) for max PROFILE_WINDOW seconds
+profiler = None 		# active cProfile.Profile or None
+profile_start = 0 		# timer value of profiling start
+profile_toggle = False 	# set by signal handler, handled in main loop
+profile_control_error = False # control file could not be removed (message printed)
+slow_telegrams = [] 	# list of (duration, time, telegram, type label) of slowest telegrams
+
+def profile_signal_handler(signum, frame):
+	# only set the request, start/stop is done in the main loop (outside of the handler)
+	global profile_toggle
+	profile_toggle = True
+	return
+
+def profile_start_stop():
+	# start or stop profiling, write profile to disk on stop
+	global profiler, profile_start
+	if profiler == None: # start
+		profiler = cProfile.Profile()
+		profile_start = time.time()
+		print(time.strftime("%c") + " Profiling started, max " + str(PROFILE_WINDOW) + " seconds")
+		profiler.enable()
+	else: # stop and save
+		profiler.disable()
+		filename = PROFILE_FILE + time.strftime("_%Y%m%d_%H%M%S")
+		try:
+			profiler.dump_stats(filename + '.prof') # for offline analysis with pstats
+			with open(filename + '.txt', 'w') as outfile: # human readable summary
+				outfile.write("Profile " + time.strftime("%F %T") + ", " + str(round(time.time() - profile_start, 1)) + " seconds\n")
+				stats = pstats.Stats(profiler, stream=outfile)
+				stats.sort_stats('cumulative').print_stats(30)
+			print(time.strftime("%c") + " Profiling stopped, saved in " + filename + ".prof")
+		except IOError as e:
+			print(time.strftime("%c") + " Profiling stopped, profile could not be saved")
+			print(e)
+		profiler = None
+	return
+
+def profile_check(now):
+	# check for toggle request (signal or control file) and the profiling window
+	global profile_toggle, profile_control_error
+	if os.path.exists(PROFILE_CONTROL_FILE):
+		try:
+			os.remove(PROFILE_CONTROL_FILE) # toggle only if removed, else it would toggle every loop
+			profile_toggle = True
+		except OSError as e:
+			if not profile_control_error: # print once
+				print(time.strftime("%c") + " Profiling control file could not be removed, ignored")
+				print(e)
+			profile_control_error = True
+	if profile_toggle:
+		profile_toggle = False
+		profile_start_stop()
+	elif profiler != None and (now - profile_start > PROFILE_WINDOW): # window expired
+		profile_start_stop()
+	return
+
+def MS_telegram_label(MS_type, MS_subtype):
+	# readable type of telegram, i.e. "SET V_TEMP"
+	messageType = MSmessageTypeLabelForID(int(MS_type))
+	if messageType in ['SET', 'REQ']:
+		messageSubType = MSsetreqLabelForID(int(MS_subtype))
+	elif messageType == 'INTERNAL':
+		messageSubType = MSinternalLabelForID(int(MS_subtype))
+	elif messageType == 'PRESENTATION':
+		messageSubType = MSpresentationLabelForID(int(MS_subtype))
+	else:
+		messageSubType = MS_subtype
+	return (str(messageType) + " " + str(messageSubType))
+
+def slow_telegram_add(duration, telegram, MS_type, MS_subtype):
+	# keep the SLOW_TELEGRAM_COUNT slowest telegrams since last report
+	global slow_telegrams
+	if len(slow_telegrams) < SLOW_TELEGRAM_COUNT or duration > slow_telegrams[-1][0]:
+		slow_telegrams.append((duration, time.strftime("%F %T"), telegram, MS_telegram_label(MS_type, MS_subtype)))
+		slow_telegrams.sort(reverse=True)
+		del slow_telegrams[SLOW_TELEGRAM_COUNT:]
+	return
+
+def slow_telegram_report():
+	# append report of slowest telegrams to SLOW_TELEGRAM_FILE and start over
+	global slow_telegrams
+	if slow_telegrams != []:
+		try:
+			with open(SLOW_TELEGRAM_FILE, 'a') as outfile:
+				outfile.write(time.strftime("%F %T") + " Slowest telegrams:\n")
+				for duration, received, telegram, label in slow_telegrams:
+					outfile.write('{:8.1f} ms  {}  {:<28} {}\n'.format(duration * 1000, received, label, telegram))
+		except IOError as e:
+			print(time.strftime("%c") + " Slow telegram report could not be saved")
+			print(e)
+		slow_telegrams = []
+	return
+
 	
 #### main loop ###
 # print start
@@ -636,9 +827,14 @@ print(CurrentTime + " Start")
 lastupdate = time.time() 				# timer value for per xx seconds update
 lastpoll_t = lastupdate					# timer value for per xx seconds polling of domoticz
 lastpoll = CurrentTime 					# sets the last domoticz database poll, checks for changes
+lastreport = lastupdate					# timer value for slow telegram report
 loop_count = 0 							# just for debug
 load_DB()								# Read of DB after restart.
 initNodeIds()							# initialize local variable used node labels from Sensor_DB
+signal.signal(PROFILE_SIGNAL, profile_signal_handler) # on demand profiling
+dcz_notify = start_dcz_notify()			# Domoticz switch notifications, None if not available
+if dcz_notify == None: 					# poll Domoticz switches every second if no notifications
+	DCZ_POLL_INTERVAL = 1
 # test
 #print(create_domoticz_dev(80))
 while 1 :
@@ -646,6 +842,8 @@ while 1 :
 	try:
 		# set variable for time delay loops
 		now = time.time()
+		# profiling: toggle request & window check
+		profile_check(now)
 		# first read messages
 		MySensors_telegram = str(ser.readline()).strip()
 		if (MySensors_telegram <> ""):
@@ -654,9 +852,14 @@ while 1 :
 			MS_node, MS_child, MS_type, MS_ack, MS_subtype, MS_payload = MySensors_telegram.split(";")
 			# ignore ack messages?
 			if int(MS_ack) == 0:
+				start = time.time()
 				process_MS_message(	MS_node, MS_child, MS_type, MS_subtype, MS_payload) # proces the message and take action
-		# delay sync DB with domoticz, test
-		if (now - lastpoll_t > 1): # once every 1 second
+				slow_telegram_add(time.time() - start, MySensors_telegram, MS_type, MS_subtype)
+		# switch changes pushed from domoticz
+		if dcz_notify != None:
+			dcz_notify.handle_request()
+		# delay sync DB with domoticz, fallback for missed notifications
+		if (now - lastpoll_t > DCZ_POLL_INTERVAL): # once every DCZ_POLL_INTERVAL seconds
 			DB_poll_dcz()
 			## test code ###
 			lastpoll_t = now
@@ -667,6 +870,11 @@ while 1 :
 			# create messages
 			lastupdate = now
 			loop_count += 1
+		
+		# report of slowest telegrams
+		if (now - lastreport > SLOW_TELEGRAM_REPORT): # once every SLOW_TELEGRAM_REPORT seconds
+			slow_telegram_report()
+			lastreport = now
 			
 		# sleep a little to avoid CPU max.load
 		time.sleep(0.3) 